@@ -0,0 +1,96 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2016, Teemu Murtola
+
+"""Exports Gerrit changes, comments, and votes as tables
+
+The script writes the same flattened records that gerrit-stats.py computes its
+statistics from into files in a given directory, for loading into other
+analysis tools.  See gerrit/export.py for a description of the tables and the
+file formats.
+
+The --cache, --update-cache, and --source options work as in gerrit-stats.py,
+and the same cache files can be shared between the scripts.  --max-age
+specifies how old closed changes are queried from Gerrit if the cache needs to
+be updated; open changes are always included.  --technical-account works as
+in gerrit-stats.py.  --author-aliases,
+--merge-by-email, and --no-merge-by-name control how accounts are mapped to
+author ids, as in gerrit-stats.py.
+"""
+
+import gerrit.export
+import gerrit.query
+
+def main():
+    """Main function for the script"""
+
+    import argparse
+    import os
+    import os.path
+
+    parser = argparse.ArgumentParser(description="""\
+            Exports records from Gerrit activity
+            """)
+    parser.add_argument('output',
+                        help='Directory to write the tables to')
+    parser.add_argument('--cache',
+                        help='Cache file to use')
+    parser.add_argument('--update-cache', action='store_true',
+                        help='Update the contents of the cache file')
+    parser.add_argument('--source', dest='sources', action='append',
+                        type=gerrit.query.GerritSource.parse,
+                        metavar='HOST[:PORT][/PROJECT,...]',
+                        help='Gerrit server (and projects) to query; can be given multiple times')
+    parser.add_argument('--technical-account', dest='technical_accounts',
+                        action='append', default=[], metavar='USERNAME',
+                        help='Additional technical account (e.g., a CI bot) to ignore; can be given multiple times')
+    parser.add_argument('--author-aliases',
+                        help='File with aliases for merging author accounts')
+    parser.add_argument('--merge-by-email', action='store_true',
+                        help='Merge author accounts with the same e-mail')
+    parser.add_argument('--no-merge-by-name', dest='merge_by_name',
+                        action='store_false',
+                        help='Do not merge author accounts with the same full name')
+    parser.add_argument('--max-age', type=int, default=365,
+                        help='Maximum age of closed changes to query, in days')
+    parser.add_argument('--query-batch', type=int, default=50,
+                        help='Batch size for gerrit query')
+    parser.add_argument('--format', choices=['csv', 'columnar'], default='csv',
+                        help='Format of the output files')
+    parser.add_argument('--chunk-size', type=int, default=65536,
+                        help='Number of rows to write at a time')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    if args.format == 'columnar':
+        writer_class = gerrit.export.ColumnarTableWriter
+    else:
+        writer_class = gerrit.export.CsvTableWriter
+
+    sources = args.sources or [gerrit.query.GerritSource()]
+    for source in sources:
+        source.technical_accounts.update(args.technical_accounts)
+    try:
+        cache = gerrit.query.GerritMultiQueryCache(args.cache, args.max_age,
+                args.query_batch, sources)
+    except ValueError as e:
+        parser.error(str(e))
+    authors = gerrit.query.AuthorRegistry(args.merge_by_email, args.merge_by_name)
+    if args.author_aliases:
+        authors.read_aliases(args.author_aliases)
+    data = gerrit.query.GerritQueryResults(authors=authors)
+    query_lines = cache.iter_query_lines(args.update_cache)
+    if authors.merges_accounts:
+        # Merge all accounts before processing any change (see gerrit-stats.py).
+        for source, lines in query_lines:
+            data.resolve_authors(lines, source)
+        query_lines = cache.iter_query_lines()
+    changes = (change for source, lines in query_lines
+            for change in data.iter_query_results(lines, source))
+    exporter = gerrit.export.GerritRecordExporter(args.output, writer_class,
+            args.chunk_size)
+    exporter.export(changes, authors)
+
+if __name__ == '__main__':
+    main()
@@ -18,19 +18,95 @@ On subsequent runs, its contents are used instead of querying Gerrit again.
 This makes it substantially faster for cases where more recent data is not
 required.
 To update an existing cache file, add --update-cache to the command line.
+
+By default, gerrit.gromacs.org is queried.  To collect statistics from other
+servers or projects, give one or more --source HOST[:PORT][/PROJECT,...]
+options.  Multiple sources are queried concurrently and combined into a single
+set of statistics.  With multiple sources, each source uses a separate cache
+file, named by appending the source name to the --cache file name.  Sources
+on the same host must not have overlapping projects.  Activity by technical
+accounts (gerrit@HOST and jenkins by default) is ignored; use
+--technical-account to give additional usernames.
+
+To avoid recomputing the statistics when the data has not changed (e.g., for
+periodically generated reports), use --result-cache to specify a directory in
+which the computed tables are stored.  Cached tables are reused if the query
+results, the date range, and the type of statistics are the same.
+
+Statistics for accounts with the same full name are combined.  To also combine
+accounts with the same e-mail, use --merge-by-email, and to combine accounts
+with different e-mails and names, give a file with --author-aliases.  Each line
+in the file has the form
+    IDENTIFIER = ALIAS[, ALIAS...]
+where the identifiers are usernames, e-mails, or names; all accounts matching
+an alias are counted under IDENTIFIER.  With --no-merge-by-name, accounts are
+only combined by e-mail/aliases, and different people with the same name get
+separate lines that show the same name.
+
+For large numbers of authors, --top limits each table to the given number of
+authors with the largest values in the column the table is sorted by.  With
+--format json or --format csv, the tables are written in a machine-readable
+format instead of as aligned text.  For JSON, the output is a single object
+with the date range and a list of tables.  CSV output can contain only a
+single table, so exactly one type of statistics must be selected.  --legend
+cannot be used with these formats.
+
+For large data sets, --stream reduces memory usage by processing the changes
+one at a time as they are read from the cache file, instead of first loading
+all of them into memory.
 """
 
+import collections
 import datetime
+import itertools
+import json
 import textwrap
+import StringIO
 
 import gerrit.query
 import gerrit.records
+import gerrit.resultcache
 from statistics import Statistics, StatisticsAuthorNameColumn, \
-        StatisticsCountColumn, StatisticsDistinctCountColumn
+        StatisticsCountColumn, StatisticsDistinctCountColumn, \
+        StatisticsPercentileColumn
+
+class AuthorStatistics(object):
+
+    """Base class for statistics grouped by author.
+
+    Subclasses provide `title`, `sort_by`, print_legend(), and get_columns(),
+    which returns a list of (GerritRecords property name, columns) pairs.
+    """
+
+    def __init__(self, top=None, output_format='text'):
+        self._top = top
+        self._output_format = output_format
+
+    def create_statistics(self):
+        stats = Statistics([StatisticsAuthorNameColumn('Name', lambda x : x.author)])
+        self._columns = self.get_columns()
+        for records_name, columns in self._columns:
+            stats.add_columns(columns)
+        return stats
 
-class AuthorChangeActivity(object):
+    def process_records(self, stats, records):
+        for records_name, columns in self._columns:
+            stats.accumulate_records(getattr(records, records_name), columns)
+
+    def print_stats(self, fp, stats):
+        stats.print_stats(fp, sort_by=self.sort_by, top=self._top,
+                output_format=self._output_format)
+
+    def do_stats(self, fp, records):
+        stats = self.create_statistics()
+        self.process_records(stats, records)
+        self.print_stats(fp, stats)
+
+
+class AuthorChangeActivity(AuthorStatistics):
 
     title = "Number of changes during date range"
+    sort_by = 'Voted'
 
     def print_legend(self, fp):
         text = """\
@@ -45,26 +121,27 @@ class AuthorChangeActivity(object):
         """
         fp.write(textwrap.dedent(text))
 
-    def do_stats(self, fp, records):
-        stats = Statistics([StatisticsAuthorNameColumn('Name', lambda x : x.author)])
-        stats.process_records(records.change_activity, [
-            StatisticsCountColumn('Created', lambda x : x.created_on),
-            StatisticsCountColumn('Merged', lambda x : x.merged_on),
-            StatisticsCountColumn('Abandoned', lambda x : x.abandoned_on),
-            StatisticsCountColumn('Both', lambda x : x.created_on and x.closed_on)
-            ])
-        stats.process_records(records.comments, [
-            StatisticsDistinctCountColumn('Commented', lambda x : x.change if x.timestamp else None)
-            ])
-        stats.process_records(records.votes, [
-            StatisticsDistinctCountColumn('Voted', lambda x : x.change if x.timestamp else None)
-            ])
-        stats.print_stats(fp, sort_by='Voted')
-
-
-class AuthorOpenChanges(object):
+    def get_columns(self):
+        return [
+            ('change_activity', [
+                StatisticsCountColumn('Created', lambda x : x.created_on),
+                StatisticsCountColumn('Merged', lambda x : x.merged_on),
+                StatisticsCountColumn('Abandoned', lambda x : x.abandoned_on),
+                StatisticsCountColumn('Both', lambda x : x.created_on and x.closed_on)
+                ]),
+            ('comments', [
+                StatisticsDistinctCountColumn('Commented', lambda x : x.change.key if x.timestamp else None)
+                ]),
+            ('votes', [
+                StatisticsDistinctCountColumn('Voted', lambda x : x.change.key if x.timestamp else None)
+                ])
+            ]
+
+
+class AuthorOpenChanges(AuthorStatistics):
 
     title = "Number of open changes by owner and status"
+    sort_by = 'Open'
 
     def print_legend(self, fp):
         text = """\
@@ -79,30 +156,31 @@ class AuthorOpenChanges(object):
         """
         fp.write(textwrap.dedent(text))
 
-    def do_stats(self, fp, records):
-        stats = Statistics([StatisticsAuthorNameColumn('Name', lambda x : x.author)])
-        stats.process_records(records.open_changes, [
-            StatisticsCountColumn('Open', lambda x : True),
-            StatisticsCountColumn('RFC/WIP', lambda x : x.is_rfc_wip),
-            StatisticsCountColumn('-Verified',
-                lambda x : not x.is_rfc_wip and not x.is_verified),
-            StatisticsCountColumn('-Review',
-                lambda x : not x.is_rfc_wip and x.is_verified and x.is_downvoted),
-            StatisticsCountColumn('Approved',
-                lambda x : not x.is_rfc_wip and x.is_verified and x.is_approved),
-            StatisticsCountColumn('+Review',
-                lambda x : not x.is_rfc_wip and x.is_verified and not x.is_approved and x.is_upvoted),
-            StatisticsCountColumn('Comments',
-                lambda x : not x.is_rfc_wip and x.is_verified and not x.is_upvoted and not x.is_downvoted and x.has_comments),
-            StatisticsCountColumn('Nothing',
-                lambda x : not x.is_rfc_wip and x.is_verified and not x.has_comments)
-            ])
-        stats.print_stats(fp, sort_by='Open')
-
-
-class AuthorOpenChangeActivity(object):
+    def get_columns(self):
+        return [
+            ('open_changes', [
+                StatisticsCountColumn('Open', lambda x : True),
+                StatisticsCountColumn('RFC/WIP', lambda x : x.is_rfc_wip),
+                StatisticsCountColumn('-Verified',
+                    lambda x : not x.is_rfc_wip and not x.is_verified),
+                StatisticsCountColumn('-Review',
+                    lambda x : not x.is_rfc_wip and x.is_verified and x.is_downvoted),
+                StatisticsCountColumn('Approved',
+                    lambda x : not x.is_rfc_wip and x.is_verified and x.is_approved),
+                StatisticsCountColumn('+Review',
+                    lambda x : not x.is_rfc_wip and x.is_verified and not x.is_approved and x.is_upvoted),
+                StatisticsCountColumn('Comments',
+                    lambda x : not x.is_rfc_wip and x.is_verified and not x.is_upvoted and not x.is_downvoted and x.has_comments),
+                StatisticsCountColumn('Nothing',
+                    lambda x : not x.is_rfc_wip and x.is_verified and not x.has_comments)
+                ])
+            ]
+
+
+class AuthorOpenChangeActivity(AuthorStatistics):
 
     title = "Activity on open changes"
+    sort_by = 'Commented'
 
     def print_legend(self, fp):
         text = """\
@@ -111,20 +189,21 @@ class AuthorOpenChangeActivity(object):
         """
         fp.write(textwrap.dedent(text))
 
-    def do_stats(self, fp, records):
-        stats = Statistics([StatisticsAuthorNameColumn('Name', lambda x : x.author)])
-        stats.process_records(records.open_comments, [
-            StatisticsDistinctCountColumn('Commented', lambda x : x.change)
-            ])
-        stats.process_records(records.open_votes, [
-            StatisticsDistinctCountColumn('Voted', lambda x : x.change)
-            ])
-        stats.print_stats(fp, sort_by='Commented')
+    def get_columns(self):
+        return [
+            ('open_comments', [
+                StatisticsDistinctCountColumn('Commented', lambda x : x.change.key)
+                ]),
+            ('open_votes', [
+                StatisticsDistinctCountColumn('Voted', lambda x : x.change.key)
+                ])
+            ]
 
 
-class AuthorActivity(object):
+class AuthorActivity(AuthorStatistics):
 
     title = "Activity during date range"
+    sort_by = 'Comments'
 
     def print_legend(self, fp):
         text = """\
@@ -135,18 +214,81 @@ class AuthorActivity(object):
         """
         fp.write(textwrap.dedent(text))
 
-    def do_stats(self, fp, records):
-        stats = Statistics([StatisticsAuthorNameColumn('Name', lambda x : x.author)])
-        stats.process_records(records.comments, [
-            StatisticsCountColumn('Comments', lambda x : x.timestamp)
-            ])
-        stats.process_records(records.technical_comments, [
-            StatisticsCountColumn('Technical', lambda x : x.timestamp)
-            ])
-        stats.process_records(records.votes, [
-            StatisticsCountColumn('Votes', lambda x : x.timestamp)
-            ])
-        stats.print_stats(fp, sort_by='Comments')
+    def get_columns(self):
+        return [
+            ('comments', [
+                StatisticsCountColumn('Comments', lambda x : x.timestamp)
+                ]),
+            ('technical_comments', [
+                StatisticsCountColumn('Technical', lambda x : x.timestamp)
+                ]),
+            ('votes', [
+                StatisticsCountColumn('Votes', lambda x : x.timestamp)
+                ])
+            ]
+
+
+class AuthorReviewLatency(AuthorStatistics):
+
+    title = "Review latency for changes created during date range"
+    sort_by = 'Changes'
+
+    def print_legend(self, fp):
+        text = """\
+        Latency of the first review on changes owned by the given author, in
+        hours from the creation of the change:
+          Changes:   Changes created
+          Reviewed:  Changes with comments or votes by others
+          Review50:  Median time to first comment or vote by others
+          Review90:  90th percentile of time to first comment or vote by others
+          Vote50:    Median time to first code review vote by others
+          Vote90:    90th percentile of time to first code review vote by others
+        """
+        fp.write(textwrap.dedent(text))
+
+    def get_columns(self):
+        return [
+            ('review_latencies', [
+                StatisticsCountColumn('Changes', lambda x : True),
+                StatisticsCountColumn('Reviewed', lambda x : x.first_review is not None),
+                StatisticsPercentileColumn('Review50', lambda x : x.first_review, 50),
+                StatisticsPercentileColumn('Review90', lambda x : x.first_review, 90),
+                StatisticsPercentileColumn('Vote50', lambda x : x.first_vote, 50),
+                StatisticsPercentileColumn('Vote90', lambda x : x.first_vote, 90)
+                ])
+            ]
+
+
+class AuthorMergeLatency(AuthorStatistics):
+
+    title = "Merge latency for changes created during date range"
+    sort_by = 'Changes'
+
+    def print_legend(self, fp):
+        text = """\
+        Time to merge and number of review rounds for changes owned by the
+        given author:
+          Changes:   Changes created
+          Merged:    Changes merged
+          Merge50:   Median time from creation to merge, in hours
+          Merge90:   90th percentile of time from creation to merge, in hours
+          Rounds50:  Median number of review rounds (patch sets with comments
+                     or votes by others)
+          Rounds90:  90th percentile of number of review rounds
+        """
+        fp.write(textwrap.dedent(text))
+
+    def get_columns(self):
+        return [
+            ('review_latencies', [
+                StatisticsCountColumn('Changes', lambda x : True),
+                StatisticsCountColumn('Merged', lambda x : x.merge is not None),
+                StatisticsPercentileColumn('Merge50', lambda x : x.merge, 50),
+                StatisticsPercentileColumn('Merge90', lambda x : x.merge, 90),
+                StatisticsPercentileColumn('Rounds50', lambda x : x.review_rounds, 50, u'{0}'),
+                StatisticsPercentileColumn('Rounds90', lambda x : x.review_rounds, 90, u'{0}')
+                ])
+            ]
 
 
 def get_date_range(args):
@@ -160,6 +302,75 @@ def get_date_range(args):
     max_age = (today - start_date).days + 1
     return start_date, end_date, max_age
 
+def compute_stats(reports, query_lines, authors, start_date, end_date):
+    """Compute statistics with all changes loaded into memory."""
+    data = gerrit.query.GerritQueryResults(authors=authors)
+    for source, lines in query_lines:
+        data.add_query_results(lines, source)
+    records = gerrit.records.GerritRecords(data, start_date, end_date)
+    outputs = dict()
+    for report in reports:
+        fp = StringIO.StringIO()
+        report.do_stats(fp, records)
+        outputs[report] = fp.getvalue()
+    return outputs
+
+def compute_stats_streaming(reports, cache, authors, start_date, end_date):
+    """Compute statistics processing changes one at a time."""
+    data = gerrit.query.GerritQueryResults(authors=authors)
+    if authors.merges_accounts:
+        # Resolve all authors first, so that accounts are merged before any
+        # change is processed, and owner checks give the same results as
+        # without streaming.
+        for source, lines in cache.iter_query_lines():
+            data.resolve_authors(lines, source)
+    changes = itertools.chain.from_iterable(
+            data.iter_query_results(lines, source)
+            for source, lines in cache.iter_query_lines())
+    all_stats = [report.create_statistics() for report in reports]
+    for records in gerrit.records.iter_change_records(changes, start_date, end_date):
+        for report, stats in zip(reports, all_stats):
+            report.process_records(stats, records)
+    outputs = dict()
+    for report, stats in zip(reports, all_stats):
+        fp = StringIO.StringIO()
+        report.print_stats(fp, stats)
+        outputs[report] = fp.getvalue()
+    return outputs
+
+def print_text(fp, reports, outputs, start_date, end_date, legend):
+    fp.write('Date range: {0} - {1}\n'.format(start_date, end_date))
+    first = True
+    for report in reports:
+        if not first:
+            fp.write('\n\n')
+        fp.write(report.title + '\n')
+        fp.write('{:=^{width}}\n\n'.format('', width=len(report.title)))
+        if legend:
+            report.print_legend(fp)
+            fp.write('\n')
+        fp.write(outputs[report])
+        first = False
+
+def print_json(fp, reports, outputs, start_date, end_date):
+    # With --format json, the output of each report is its rows as JSON.
+    statistics = [collections.OrderedDict([
+            ('type', type(report).__name__),
+            ('title', report.title),
+            ('rows', json.loads(outputs[report],
+                object_pairs_hook=collections.OrderedDict))])
+        for report in reports]
+    document = collections.OrderedDict([
+            ('start_date', str(start_date)),
+            ('end_date', str(end_date)),
+            ('statistics', statistics)])
+    json.dump(document, fp, indent=1, separators=(',', ': '))
+    fp.write('\n')
+
+def print_csv(fp, reports, outputs):
+    assert len(reports) == 1
+    fp.write(outputs[reports[0]])
+
 def main():
     """Main function for the script"""
 
@@ -174,12 +385,37 @@ def main():
                         help='Cache file to use')
     parser.add_argument('--update-cache', action='store_true',
                         help='Update the contents of the cache file')
+    parser.add_argument('--source', dest='sources', action='append',
+                        type=gerrit.query.GerritSource.parse,
+                        metavar='HOST[:PORT][/PROJECT,...]',
+                        help='Gerrit server (and projects) to query; can be given multiple times')
+    parser.add_argument('--technical-account', dest='technical_accounts',
+                        action='append', default=[], metavar='USERNAME',
+                        help='Additional technical account (e.g., a CI bot) to ignore; can be given multiple times')
+    parser.add_argument('--author-aliases',
+                        help='File with aliases for merging author accounts')
+    parser.add_argument('--merge-by-email', action='store_true',
+                        help='Merge author accounts with the same e-mail')
+    parser.add_argument('--no-merge-by-name', dest='merge_by_name',
+                        action='store_false',
+                        help='Do not merge author accounts with the same full name')
+    parser.add_argument('--result-cache',
+                        help='Directory for caching computed statistics')
+    parser.add_argument('--result-cache-size', type=int, default=100,
+                        help='Maximum number of entries in the result cache')
     parser.add_argument('--prev-month', action='store_true',
                         help='Show statistics for previous month (default)')
     parser.add_argument('--year', type=int,
                         help='Show statistics for given year')
+    parser.add_argument('--stream', action='store_true',
+                        help='Process changes one at a time to reduce memory usage')
     parser.add_argument('--query-batch', type=int, default=50,
                         help='Batch size for gerrit query')
+    parser.add_argument('--top', type=int,
+                        help='Only show the given number of authors in each table')
+    parser.add_argument('--format', dest='output_format', default='text',
+                        choices=['text', 'json', 'csv'],
+                        help='Output format for the statistics tables; csv requires exactly one type of statistics option (not --all)')
     parser.add_argument('--legend', action='store_true',
                         help='Print explanation of columns for each statistics table')
     group = parser.add_argument_group(title='Type of statistics')
@@ -197,32 +433,77 @@ def main():
     group.add_argument('--activity', dest='stats', action='append_const',
                        const=AuthorActivity,
                        help='Print statistics on recent activity by author')
+    group.add_argument('--review-latency', dest='stats', action='append_const',
+                       const=AuthorReviewLatency,
+                       help='Print statistics on time to first review by author')
+    group.add_argument('--merge-latency', dest='stats', action='append_const',
+                       const=AuthorMergeLatency,
+                       help='Print statistics on time to merge and review rounds by author')
     args = parser.parse_args()
 
     stats = args.stats
     if not stats or args.all_stats:
         stats = [AuthorOpenChanges, AuthorOpenChangeActivity,
-                AuthorChangeActivity, AuthorActivity]
+                AuthorChangeActivity, AuthorActivity, AuthorReviewLatency,
+                AuthorMergeLatency]
+    if args.output_format == 'csv' and len(stats) != 1:
+        parser.error('--format csv requires exactly one type of statistics')
+    if args.output_format != 'text' and args.legend:
+        parser.error('--legend can only be used with --format text')
 
     start_date, end_date, max_age = get_date_range(args)
-    sys.stdout.write('Date range: {0} - {1}\n'.format(start_date, end_date))
 
-    cache = gerrit.query.GerritQueryCache(args.cache, max_age, args.query_batch)
-    data = cache.get_query_results(args.update_cache)
-    records = gerrit.records.GerritRecords(data, start_date, end_date)
-
-    first = True
-    for stat_type in stats:
-        if not first:
-            sys.stdout.write('\n\n')
-        stat = stat_type()
-        sys.stdout.write(stat.title + '\n')
-        sys.stdout.write('{:=^{width}}\n\n'.format('', width=len(stat.title)))
-        if args.legend:
-            stat.print_legend(sys.stdout)
-            sys.stdout.write('\n')
-        stat.do_stats(sys.stdout, records)
-        first = False
+    sources = args.sources or [gerrit.query.GerritSource()]
+    for source in sources:
+        source.technical_accounts.update(args.technical_accounts)
+    try:
+        cache = gerrit.query.GerritMultiQueryCache(args.cache, max_age,
+                args.query_batch, sources)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.stream:
+        query_lines = cache.iter_query_lines(args.update_cache)
+    else:
+        query_lines = cache.get_query_lines(args.update_cache)
+    authors = gerrit.query.AuthorRegistry(args.merge_by_email, args.merge_by_name)
+    if args.author_aliases:
+        authors.read_aliases(args.author_aliases)
+    reports = [stat_type(args.top, args.output_format) for stat_type in stats]
+    outputs = dict()
+    result_cache = None
+    if args.result_cache:
+        result_cache = gerrit.resultcache.ReportResultCache(args.result_cache,
+                args.result_cache_size)
+        fingerprint = gerrit.resultcache.compute_fingerprint(query_lines)
+        keys = dict()
+        for report in reports:
+            keys[report] = result_cache.get_key(fingerprint,
+                    type(report).__name__, start_date, end_date,
+                    [authors.config_key, str(args.top), args.output_format])
+            output = result_cache.get(keys[report])
+            if output is not None:
+                outputs[report] = output
+
+    missing = [report for report in reports if report not in outputs]
+    if missing:
+        if args.stream:
+            new_outputs = compute_stats_streaming(missing, cache,
+                    authors, start_date, end_date)
+        else:
+            new_outputs = compute_stats(missing, query_lines,
+                    authors, start_date, end_date)
+        if result_cache:
+            for report, output in new_outputs.iteritems():
+                result_cache.put(keys[report], output)
+        outputs.update(new_outputs)
+
+    if args.output_format == 'json':
+        print_json(sys.stdout, reports, outputs, start_date, end_date)
+    elif args.output_format == 'csv':
+        print_csv(sys.stdout, reports, outputs)
+    else:
+        print_text(sys.stdout, reports, outputs, start_date, end_date,
+                args.legend)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,219 @@
+# Copyright (c) 2016, Teemu Murtola
+
+"""Classes to export Gerrit records as tables for external analysis.
+
+The records are written into four tables:
+  authors:  id, canonical_id, username, fullname, technical
+  changes:  id, source, project, number, owner_id, status, created_on,
+            merged_on, abandoned_on
+  comments: change_id, author_id, timestamp, technical
+  votes:    change_id, author_id, timestamp, value
+All timestamps are in seconds since the epoch.  The rows in the authors table
+are Gerrit accounts, and owner_id/author_id refer to their `id`.  Accounts
+that are merged into the same person (see gerrit.query.AuthorRegistry) have
+the same `canonical_id`, which is the `id` of the account whose username and
+name should be used for the person.
+
+Two formats are supported.  CSV files have a header row, and missing values
+are written as empty fields.  Columnar files (.col) consist of
+  - a 'GCOL1\\n' magic line,
+  - a JSON line with a list of [column name, type] pairs, where type is
+    'int' or 'str',
+  - any number of row groups, each consisting of the number of rows as a
+    little-endian uint32 followed by the data for each column in order.
+    An 'int' column is an array of little-endian int64 values, with missing
+    values stored as -2**63.  A 'str' column is an array of little-endian
+    int32 byte lengths, followed by the concatenated UTF-8 encoded strings.
+    Missing values in 'str' columns are stored as empty strings, so they
+    cannot be distinguished from actual empty strings (the same holds for
+    CSV files).
+Columnar files can be read with read_columnar().  Since the 'int' columns are
+stored as contiguous arrays, they can also be loaded directly into, e.g.,
+numpy arrays (numpy.frombuffer with dtype '<i8').
+"""
+
+import collections
+import csv
+import datetime
+import json
+import os.path
+import struct
+
+import gerrit.records
+
+_missing_int = -2**63
+
+def _to_epoch(timestamp):
+    if not timestamp:
+        return None
+    return timestamp.epoch
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def read_columnar(path):
+    """Read a columnar file written by ColumnarTableWriter.
+
+    Returns an ordered dictionary that maps column names to lists of values.
+    Missing values are None in 'int' columns and empty in 'str' columns."""
+    with open(path, 'rb') as fp:
+        if fp.readline() != 'GCOL1\n':
+            raise ValueError('Not a columnar file: ' + path)
+        columns = json.loads(fp.readline())
+        data = collections.OrderedDict((name, list()) for name, column_type in columns)
+        while True:
+            header = fp.read(4)
+            if not header:
+                break
+            row_count = struct.unpack('<I', header)[0]
+            for name, column_type in columns:
+                if column_type == 'int':
+                    values = struct.unpack('<{0}q'.format(row_count),
+                            fp.read(8 * row_count))
+                    data[name].extend([None if value == _missing_int else value
+                            for value in values])
+                else:
+                    lengths = struct.unpack('<{0}i'.format(row_count),
+                            fp.read(4 * row_count))
+                    blob = fp.read(sum(lengths))
+                    offset = 0
+                    for length in lengths:
+                        data[name].append(blob[offset:offset + length].decode('utf-8'))
+                        offset += length
+    return data
+
+
+class TableWriter(object):
+
+    """Base class for writing a table in chunks of rows.
+
+    Rows are buffered, and written out using _write_chunk() when `chunk_size`
+    rows have been added, and on close().
+    """
+
+    def __init__(self, path, columns, chunk_size):
+        self._columns = columns
+        self._chunk_size = chunk_size
+        self._rows = list()
+        self._fp = open(path + '.' + self.extension, 'wb', 1 << 20)
+
+    def add_row(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self._chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            self._write_chunk(self._rows)
+            self._rows = list()
+
+    def close(self):
+        self.flush()
+        self._fp.close()
+
+
+class CsvTableWriter(TableWriter):
+
+    """Writes a table as a CSV file."""
+
+    extension = 'csv'
+
+    def __init__(self, path, columns, chunk_size):
+        TableWriter.__init__(self, path, columns, chunk_size)
+        self._writer = csv.writer(self._fp)
+        self._writer.writerow([name for name, column_type in columns])
+
+    def _write_chunk(self, rows):
+        self._writer.writerows([[_encode(value) for value in row] for row in rows])
+
+
+class ColumnarTableWriter(TableWriter):
+
+    """Writes a table as a typed binary columnar file."""
+
+    extension = 'col'
+
+    def __init__(self, path, columns, chunk_size):
+        TableWriter.__init__(self, path, columns, chunk_size)
+        self._fp.write('GCOL1\n')
+        self._fp.write(json.dumps(columns) + '\n')
+
+    def _write_chunk(self, rows):
+        self._fp.write(struct.pack('<I', len(rows)))
+        for index, (name, column_type) in enumerate(self._columns):
+            values = [row[index] for row in rows]
+            if column_type == 'int':
+                values = [_missing_int if value is None else value
+                        for value in values]
+                self._fp.write(struct.pack('<{0}q'.format(len(values)), *values))
+            else:
+                values = [_encode(value) or '' for value in values]
+                lengths = [len(value) for value in values]
+                self._fp.write(struct.pack('<{0}i'.format(len(lengths)), *lengths))
+                self._fp.write(''.join(values))
+
+
+class GerritRecordExporter(object):
+
+    """Exports records from Gerrit changes into tables.
+
+    Changes are processed one at a time, so the memory usage only depends on
+    the number of authors and the chunk size.
+    """
+
+    authors_columns = [('id', 'int'), ('canonical_id', 'int'),
+            ('username', 'str'), ('fullname', 'str'), ('technical', 'int')]
+    changes_columns = [('id', 'int'), ('source', 'str'), ('project', 'str'),
+            ('number', 'int'), ('owner_id', 'int'), ('status', 'str'),
+            ('created_on', 'int'), ('merged_on', 'int'), ('abandoned_on', 'int')]
+    comments_columns = [('change_id', 'int'), ('author_id', 'int'),
+            ('timestamp', 'int'), ('technical', 'int')]
+    votes_columns = [('change_id', 'int'), ('author_id', 'int'),
+            ('timestamp', 'int'), ('value', 'int')]
+
+    def __init__(self, directory, writer_class, chunk_size):
+        self._directory = directory
+        self._writer_class = writer_class
+        self._chunk_size = chunk_size
+
+    def export(self, changes, authors):
+        """Export the given changes, and all authors in an AuthorRegistry.
+
+        `changes` can be a generator that resolves authors using `authors`,
+        since the authors are exported after all the changes."""
+        changes_table = self._create_writer('changes', self.changes_columns)
+        comments_table = self._create_writer('comments', self.comments_columns)
+        votes_table = self._create_writer('votes', self.votes_columns)
+        all_records = gerrit.records.iter_change_records(changes,
+                datetime.date.min, datetime.date.max)
+        for change_id, records in enumerate(all_records):
+            for record in records.change_activity:
+                change = record.change
+                changes_table.add_row([change_id, change.source, change.project,
+                    int(change.number), record.author.account_id,
+                    change.status, _to_epoch(record.created_on),
+                    _to_epoch(record.merged_on), _to_epoch(record.abandoned_on)])
+            for technical, comments in ((0, records.comments),
+                    (1, records.technical_comments)):
+                for record in comments:
+                    comments_table.add_row([change_id, record.author.account_id,
+                        _to_epoch(record.timestamp), technical])
+            for record in records.votes:
+                votes_table.add_row([change_id, record.author.account_id,
+                    _to_epoch(record.timestamp), record.value])
+        changes_table.close()
+        comments_table.close()
+        votes_table.close()
+        authors_table = self._create_writer('authors', self.authors_columns)
+        for author in authors:
+            authors_table.add_row([author.account_id, author.author_id,
+                author.account_username, author.account_fullname,
+                int(author.technical_account)])
+        authors_table.close()
+
+    def _create_writer(self, name, columns):
+        path = os.path.join(self._directory, name)
+        return self._writer_class(path, columns, self._chunk_size)
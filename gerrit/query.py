@@ -4,15 +4,32 @@
 
 import datetime
 import json
+import multiprocessing.pool
 import os.path
 import re
 import subprocess
 
+class Timestamp(datetime.datetime):
+
+    """Local time for a Gerrit timestamp.
+
+    In addition to the local time, keeps the original Gerrit value (seconds
+    since the epoch) in `epoch`, since converting the local time back is
+    ambiguous around daylight saving time changes.
+    """
+
+    @staticmethod
+    def from_epoch(epoch):
+        result = Timestamp.fromtimestamp(epoch)
+        result.epoch = int(epoch)
+        return result
+
+
 def _convert_time(timestamp):
     """Convert Gerrit timestamps to Python objects."""
     if not timestamp:
         return None
-    return datetime.datetime.fromtimestamp(timestamp)
+    return Timestamp.from_epoch(timestamp)
 
 
 class Approval(object):
@@ -38,15 +55,220 @@ class Approval(object):
 
 class Author(object):
 
-    """Data for a Gerrit author."""
+    """Data for a single Gerrit account.
+
+    Accounts that belong to the same person are merged by an AuthorRegistry.
+    `account_id` identifies the account, and `author_id` the merged author
+    (i.e., it is the same for all merged accounts).  `username` and `fullname`
+    are those of the canonical account of the merged author, while
+    `account_username` and `account_fullname` are those of this account.
+    """
 
-    def __init__(self, username, fullname):
-        self.username = username
-        self.fullname = fullname
+    def __init__(self, registry, account_id, username, fullname, has_username,
+            is_technical_account):
+        self._registry = registry
+        self.account_id = account_id
+        self.account_username = username
+        self.account_fullname = fullname
+        self.has_username = has_username
+        self.is_technical_account = is_technical_account
+
+    @property
+    def author_id(self):
+        return self._registry.get_author_id(self.account_id)
+
+    @property
+    def username(self):
+        return self._registry.get_canonical_account(self.account_id).account_username
+
+    @property
+    def fullname(self):
+        return self._registry.get_canonical_account(self.account_id).account_fullname
 
     @property
     def technical_account(self):
-        return self.username in ('gerrit@gerrit.gromacs.org', 'jenkins')
+        """Whether this or any account merged with it is a technical account."""
+        return self._registry.is_technical(self.account_id)
+
+
+class ChangeEvent(object):
+
+    """Single event in the history of a Gerrit change."""
+
+    class Type(object):
+
+        """Enumeration for event types."""
+
+        upload = 'upload'
+        comment = 'comment'
+        vote = 'vote'
+        submit = 'submit'
+        abandon = 'abandon'
+
+    def __init__(self, event_type, timestamp, author, value=None):
+        self.event_type = event_type
+        self.timestamp = timestamp
+        self.author = author
+        self.value = value
+
+
+class AuthorRegistry(object):
+
+    """Maps Gerrit accounts to authors with integer ids.
+
+    An account is identified by its username or, if it does not have one, by
+    its e-mail or name.  Accounts can be merged into a single author in two
+    ways:
+      - Aliases map account usernames, e-mails, or names to an identifier.
+        All accounts that have a username, e-mail, or name that is either an
+        alias for an identifier or the identifier itself are the same author.
+      - With `merge_by_email` or `merge_by_name`, accounts with the same e-mail
+        or name are also considered the same author.  Merging by name is on
+        by default, since authors used to be identified only by their name.
+    Merging is transitive, and does not depend on the order in which the
+    accounts are seen.  Each merged author uses the username and name of one
+    of its accounts, preferring the account whose username is an alias
+    identifier and then accounts that have a username.  An author is a
+    technical account if any of its accounts is.
+    """
+
+    def __init__(self, merge_by_email=False, merge_by_name=True):
+        self._merge_by_email = merge_by_email
+        self._merge_by_name = merge_by_name
+        self._aliases = dict()
+        self._identifiers = set()
+        self._accounts = list()
+        self._parents = list()
+        self._technical = list()
+        self._index = dict()
+
+    def __iter__(self):
+        """Iterate over all accounts."""
+        return iter(self._accounts)
+
+    def __len__(self):
+        return len(self._accounts)
+
+    def add_alias(self, alias, identifier):
+        """Make accounts with `alias` as username/e-mail/name map to `identifier`."""
+        self._aliases[alias] = identifier
+        self._identifiers.add(identifier)
+
+    def read_aliases(self, filename):
+        """Read aliases from a file.
+
+        Each line in the file has the form
+            IDENTIFIER = ALIAS[, ALIAS...]
+        Empty lines and lines starting with '#' are ignored."""
+        with open(filename, 'r') as fp:
+            for line in fp:
+                line = line.decode('utf-8').strip()
+                if not line or line.startswith('#'):
+                    continue
+                identifier, _, aliases = line.partition('=')
+                if not aliases:
+                    raise ValueError('Invalid alias line: ' + line)
+                for alias in aliases.split(','):
+                    self.add_alias(alias.strip(), identifier.strip())
+
+    @property
+    def merges_accounts(self):
+        """Whether any accounts can be merged with the configuration."""
+        return bool(self._merge_by_email or self._merge_by_name or self._aliases)
+
+    @property
+    def config_key(self):
+        """Return a string that identifies the merging configuration."""
+        return json.dumps([self._merge_by_email, self._merge_by_name,
+            sorted(self._aliases.iteritems())])
+
+    def get_author_id(self, account_id):
+        """Return the id of the author that the account is merged into."""
+        parents = self._parents
+        root = account_id
+        while parents[root] != root:
+            root = parents[root]
+        while parents[account_id] != root:
+            parents[account_id], account_id = root, parents[account_id]
+        return root
+
+    def get_canonical_account(self, account_id):
+        return self._accounts[self.get_author_id(account_id)]
+
+    def is_technical(self, account_id):
+        return self._technical[self.get_author_id(account_id)]
+
+    def resolve(self, author_json, technical_accounts=()):
+        """Add/resolve an author from a decoded JSON entry.
+
+        `technical_accounts` lists usernames of technical accounts (see
+        GerritSource) on the server that the entry comes from."""
+        email = None
+        name = "Unknown"
+        if not author_json:
+            username = '<unknown>'
+        else:
+            username = author_json.get('username')
+            email = author_json.get('email')
+            name = author_json.get('name')
+        if username:
+            key = ('username', username)
+        elif email:
+            # If username is not specified, hopefully the e-mail is unique.
+            # This gets triggered for some duplicate users, as well as for the
+            # internal Gerrit user.
+            key = ('email', email)
+        else:
+            assert name
+            key = ('name', name)
+        is_technical = key[1] in technical_accounts
+        account_id = self._index.get(key)
+        if account_id is not None:
+            author = self._accounts[account_id]
+            if is_technical and not author.is_technical_account:
+                # The same username can be technical only on some servers.
+                author.is_technical_account = True
+                self._technical[self.get_author_id(account_id)] = True
+            return author
+        account_id = len(self._accounts)
+        author = Author(self, account_id, key[1], name, bool(username),
+                is_technical)
+        self._accounts.append(author)
+        self._parents.append(account_id)
+        self._technical.append(is_technical)
+        self._index[key] = account_id
+        keys = list()
+        if self._merge_by_email and email:
+            keys.append(('email', email))
+        if self._merge_by_name and name:
+            keys.append(('name', name))
+        for value in (username, email, name):
+            if value in self._aliases:
+                keys.append(('alias', self._aliases[value]))
+            if value in self._identifiers:
+                keys.append(('alias', value))
+        for key in keys:
+            other_id = self._index.setdefault(key, account_id)
+            if other_id != account_id:
+                self._merge(account_id, other_id)
+        return author
+
+    def _merge(self, first_id, second_id):
+        first_root = self.get_author_id(first_id)
+        second_root = self.get_author_id(second_id)
+        if first_root == second_root:
+            return
+        if self._get_priority(first_root) < self._get_priority(second_root):
+            first_root, second_root = second_root, first_root
+        self._parents[second_root] = first_root
+        self._technical[first_root] = \
+                self._technical[first_root] or self._technical[second_root]
+
+    def _get_priority(self, account_id):
+        """Return a sort key for choosing the canonical account (largest wins)."""
+        account = self._accounts[account_id]
+        return (account.has_username and account.account_username in self._identifiers,
+                account.has_username, -account_id)
 
 
 class Change(object):
@@ -63,7 +285,11 @@ class Change(object):
         submitted = 'SUBMITTED'
         new = 'NEW'
 
-    def __init__(self, change_json, resolve_author):
+    def __init__(self, change_json, resolve_author, source=None):
+        if source is None:
+            source = GerritSource()
+        self.source = source.name
+        self.host = source.host
         self.project = change_json.get('project')
         self.branch = change_json.get('branch')
         self.change_id = change_json.get('id')
@@ -83,14 +309,78 @@ class Change(object):
         if patchsets_json:
             for patchset_json in patchsets_json:
                 self.patchsets.append(PatchSet(patchset_json, resolve_author))
-        self.review_comments = list([comment for comment in self.comments
-                if comment.reviewer != self.owner
-                and not comment.reviewer.technical_account
-                and not comment.technical_comment])
-        self.technical_comments = list([comment for comment in self.comments
-                if comment.reviewer != self.owner
-                and not comment.reviewer.technical_account
-                and comment.technical_comment])
+        self._review_comments = None
+        self._technical_comments = None
+        self._timeline = None
+
+    @property
+    def key(self):
+        """Key that identifies the change uniquely across all sources."""
+        return (self.host, self.number)
+
+    @property
+    def review_comments(self):
+        """Return non-technical comments by others than the owner.
+
+        Computed on first access, so all accounts should be merged before
+        that (see AuthorRegistry)."""
+        if self._review_comments is None:
+            self._review_comments = [comment for comment in self._get_other_comments()
+                    if not comment.technical_comment]
+        return self._review_comments
+
+    @property
+    def technical_comments(self):
+        """Return technical comments by others than the owner."""
+        if self._technical_comments is None:
+            self._technical_comments = [comment for comment in self._get_other_comments()
+                    if comment.technical_comment]
+        return self._technical_comments
+
+    def _get_other_comments(self):
+        return [comment for comment in self.comments
+                if comment.reviewer.author_id != self.owner.author_id
+                and not comment.reviewer.technical_account]
+
+    @property
+    def timeline(self):
+        """Return all events on the change as a list sorted by time.
+
+        The list contains an upload event for each patch set, a comment event
+        for each non-technical comment, a vote event for each code review vote,
+        and submit/abandon events for merged/abandoned changes.  The list is
+        built on first access and cached."""
+        if self._timeline is None:
+            self._timeline = self._build_timeline()
+        return self._timeline
+
+    def _build_timeline(self):
+        events = list()
+        for patchset in self.patchsets:
+            events.append(ChangeEvent(ChangeEvent.Type.upload,
+                patchset.created_on, patchset.uploader, patchset.number))
+            for approval in patchset.get_approvals(Approval.Type.code_review):
+                events.append(ChangeEvent(ChangeEvent.Type.vote,
+                    approval.granted_on, approval.by, approval.value))
+            for approval in patchset.get_approvals(Approval.Type.submit):
+                events.append(ChangeEvent(ChangeEvent.Type.submit,
+                    approval.granted_on, approval.by))
+        abandon_comment = None
+        if self.status == Change.Status.abandoned:
+            for comment in reversed(self.comments):
+                if comment.message.startswith('Abandoned'):
+                    abandon_comment = comment
+                    break
+        for comment in self.comments:
+            if comment is abandon_comment:
+                events.append(ChangeEvent(ChangeEvent.Type.abandon,
+                    comment.timestamp, comment.reviewer))
+            elif not comment.technical_comment:
+                events.append(ChangeEvent(ChangeEvent.Type.comment,
+                    comment.timestamp, comment.reviewer))
+        events = [event for event in events if event.timestamp]
+        events.sort(key=lambda x: x.timestamp)
+        return events
 
     @property
     def last_patchset(self):
@@ -185,26 +475,85 @@ class PatchSet(object):
 
 class GerritQueryResults(object):
 
-    """Parses and stores data retrieved from `gerrit query`."""
+    """Parses and stores data retrieved from `gerrit query`.
 
-    def __init__(self, query_results):
-        self._authors = dict()
+    Results from multiple sources can be merged into a single object with
+    add_query_results(); authors are shared between all the sources.
+    """
+
+    def __init__(self, query_results=None, source=None, authors=None):
+        if authors is None:
+            authors = AuthorRegistry()
+        self._authors = authors
         self._changes = list()
+        self._public_changes = list()
+        self._open_changes = list()
+        if query_results is not None:
+            self.add_query_results(query_results, source)
+
+    def add_query_results(self, query_results, source=None):
+        """Add changes from `gerrit query` output lines.
+
+        `source` is the GerritSource the results came from (by default, the
+        default GerritSource)."""
+        first_new = len(self._changes)
+        self._changes.extend(self.iter_query_results(query_results, source))
+        new_changes = self._changes[first_new:]
+        public_changes = filter(lambda x: not x.is_draft, new_changes)
+        self._public_changes.extend(public_changes)
+        self._open_changes.extend(filter(lambda x: x.is_open, public_changes))
+
+    def iter_query_results(self, query_results, source=None):
+        """Decode changes from `gerrit query` output lines one at a time.
+
+        The changes are not stored, so memory use does not grow with the
+        number of changes (only with the number of authors)."""
+        if source is None:
+            source = GerritSource()
+        resolve_author = lambda x: self._authors.resolve(x,
+                source.technical_accounts)
         for line in query_results:
             entry = json.loads(line)
             entry_type = entry.get('type')
             if entry_type and entry_type == 'stats':
                 # TODO: Parse the stats
                 continue
-            self._add_change(entry)
-        self._public_changes = filter(lambda x: not x.is_draft, self._changes)
-        self._open_changes = filter(lambda x: x.is_open, self._public_changes)
+            yield Change(entry, resolve_author, source)
+
+    def resolve_authors(self, query_results, source=None):
+        """Resolve all authors in `gerrit query` output lines.
+
+        This does not create the changes, and can be used to merge all the
+        accounts before processing the changes with iter_query_results()."""
+        if source is None:
+            source = GerritSource()
+        for line in query_results:
+            entry = json.loads(line)
+            entry_type = entry.get('type')
+            if entry_type and entry_type == 'stats':
+                continue
+            self._authors.resolve(entry.get('owner'), source.technical_accounts)
+            for comment_json in entry.get('comments') or []:
+                self._authors.resolve(comment_json.get('reviewer'),
+                        source.technical_accounts)
+            for patchset_json in entry.get('patchSets') or []:
+                for field in ('uploader', 'author'):
+                    self._authors.resolve(patchset_json.get(field),
+                            source.technical_accounts)
+                for approval_json in patchset_json.get('approvals') or []:
+                    self._authors.resolve(approval_json.get('by'),
+                            source.technical_accounts)
 
     @staticmethod
     def has_more_results(query_results):
         stats = json.loads(query_results.splitlines()[-1])
         return stats['moreChanges']
 
+    @property
+    def authors(self):
+        """Return the AuthorRegistry for all authors."""
+        return self._authors
+
     @property
     def public_changes(self):
         """Return all non-draft changes."""
@@ -215,52 +564,126 @@ class GerritQueryResults(object):
         """Return all open non-draft changes."""
         return self._open_changes
 
-    def _add_change(self, change_json):
-        """Add a change from a decoded JSON entry."""
-        self._changes.append(Change(change_json, self._resolve_author))
 
-    def _resolve_author(self, author_json):
-        """Add/resolve an author from a decoded JSON entry."""
-        if not author_json:
-            username = '<unknown>'
+class GerritSource(object):
+
+    """Gerrit server (and optionally, a set of projects) to query.
+
+    `technical_accounts` lists the usernames of accounts on the server that
+    are not people (the internal Gerrit user and CI bots); activity by them is
+    not counted as reviews.  By default, these are 'gerrit@HOST' and 'jenkins'.
+    """
+
+    default_host = 'gerrit.gromacs.org'
+    default_port = 29418
+    default_technical_accounts = ['jenkins']
+
+    def __init__(self, host=None, port=None, projects=None,
+            technical_accounts=None):
+        self.host = host or GerritSource.default_host
+        self.port = int(port or GerritSource.default_port)
+        self.projects = list(projects or [])
+        if technical_accounts is None:
+            technical_accounts = ['gerrit@' + self.host] + \
+                    GerritSource.default_technical_accounts
+        self.technical_accounts = set(technical_accounts)
+
+    def overlaps(self, other):
+        """Whether the two sources can return the same changes."""
+        if self.host != other.host:
+            return False
+        if not self.projects or not other.projects:
+            return True
+        return bool(set(self.projects) & set(other.projects))
+
+    @staticmethod
+    def parse(spec):
+        """Create a source from a HOST[:PORT][/PROJECT[,PROJECT...]] string."""
+        server, _, projects = spec.partition('/')
+        host, _, port = server.partition(':')
+        projects = [x for x in projects.split(',') if x]
+        return GerritSource(host, port, projects)
+
+    @property
+    def name(self):
+        name = '{0}:{1}'.format(self.host, self.port)
+        if self.projects:
+            name += '/' + ','.join(self.projects)
+        return name
+
+    def get_cache_filename(self, filename):
+        """Return a cache file name specific to this source."""
+        if not filename:
+            return None
+        return '{0}.{1}'.format(filename, re.sub(r'[^\w.-]+', '_', self.name))
+
+    def get_query_command(self, max_age, batch_size, start):
+        query = ['ssh', '-p', str(self.port), self.host, 'gerrit', 'query',
+                '--format=JSON', '--all-approvals', '--comments', '-S', str(start),
+                '--']
+        if self.projects:
+            query.extend(['(', '-age:{0}d'.format(max_age), 'OR', 'status:open', ')'])
+            query.append('(')
+            for index, project in enumerate(self.projects):
+                if index > 0:
+                    query.append('OR')
+                query.append('project:{0}'.format(project))
+            query.append(')')
         else:
-            username = author_json.get('username')
-        if not username:
-            # If username is not specified, hopefully the e-mail is unique.
-            # This gets triggered for some duplicate users, as well as for the
-            # internal Gerrit user.
-            # TODO: Consider merging duplicate users, if they can be recognized.
-            username = author_json.get('email')
-            if not username:
-                username = author_json.get('name')
-            assert username
-        author = self._authors.get(username)
-        if not author:
-            name = "Unknown"
-            if author_json:
-                name = author_json.get('name')
-            author = Author(username, name)
-            self._authors[username] = author
-        return author
+            query.extend(['-age:{0}d'.format(max_age), 'OR', 'status:open'])
+        query.append('limit:{0}'.format(batch_size))
+        return query
 
 
 class GerritQueryCache(object):
 
     """Manages a cache of results from `gerrit query`."""
 
-    def __init__(self, filename, max_age, batch_size):
+    def __init__(self, filename, max_age, batch_size, source=None):
         self._filename = filename
         self._max_age = max_age
         self._batch_size = batch_size
+        self._source = source or GerritSource()
         self._query_results = None
 
-    def get_query_results(self, force_update=False):
-        update = force_update or not self._filename or not os.path.exists(self._filename)
-        if not update:
+    @property
+    def source(self):
+        return self._source
+
+    def get_query_lines(self, force_update=False):
+        """Return the raw `gerrit query` output lines."""
+        if self._needs_update(force_update):
+            self._update_cache()
+        if self._query_results is None:
             self._read_cache()
-        if update:
+        return self._query_results
+
+    def iter_query_lines(self, force_update=False):
+        """Iterate over the raw `gerrit query` output lines.
+
+        If there is a cache file, the lines are read lazily from it instead of
+        reading all of them into memory."""
+        if self._needs_update(force_update):
             self._update_cache()
-        return GerritQueryResults(self._query_results)
+        if self._query_results is not None:
+            return iter(self._query_results)
+        return self._iter_cache()
+
+    def get_query_results(self, force_update=False):
+        query_results = self.get_query_lines(force_update)
+        return GerritQueryResults(query_results, self._source)
+
+    def _needs_update(self, force_update):
+        if force_update:
+            return True
+        if self._query_results is not None:
+            return False
+        return not self._filename or not os.path.exists(self._filename)
+
+    def _iter_cache(self):
+        with open(self._filename, 'r') as fp:
+            for line in fp:
+                yield line
 
     def _read_cache(self):
         with open(self._filename, 'r') as fp:
@@ -268,19 +691,90 @@ class GerritQueryCache(object):
         self._query_results = lines
 
     def _update_cache(self):
-        query_results = ''
+        """Run the query, storing the results in the cache file if there is one.
+
+        Each batch is written to the cache file as it arrives, so that the
+        results are not all kept in memory.  Without a cache file, the results
+        are stored in memory."""
+        self._query_results = None
+        fp = None
+        if self._filename:
+            fp = open(self._filename + '.tmp', 'w')
+        else:
+            query_results = list()
         start = 0
         more_results = True
-        while more_results:
-            query = ['ssh', '-p', '29418', 'gerrit.gromacs.org', 'gerrit', 'query',
-                    '--format=JSON', '--all-approvals', '--comments', '-S', str(start),
-                    '--', '-age:{0}d'.format(self._max_age), 'OR', 'status:open',
-                    'limit:{0}'.format(self._batch_size)]
-            results = subprocess.check_output(query)
-            more_results = GerritQueryResults.has_more_results(results)
-            query_results += results
-            start += self._batch_size
-        if self._filename:
-            with open(self._filename, 'w') as fp:
-                fp.write(query_results)
-        self._query_results = query_results.splitlines()
+        success = False
+        try:
+            while more_results:
+                query = self._source.get_query_command(self._max_age,
+                        self._batch_size, start)
+                results = subprocess.check_output(query)
+                more_results = GerritQueryResults.has_more_results(results)
+                if fp:
+                    fp.write(results)
+                else:
+                    query_results.extend(results.splitlines())
+                start += self._batch_size
+            success = True
+        finally:
+            if fp:
+                fp.close()
+                if not success:
+                    os.remove(self._filename + '.tmp')
+        if fp:
+            os.rename(self._filename + '.tmp', self._filename)
+        else:
+            self._query_results = query_results
+
+
+class GerritMultiQueryCache(object):
+
+    """Manages caches for multiple Gerrit sources.
+
+    The sources are queried concurrently, each with its own cache file, and the
+    results are merged into a single GerritQueryResults object.
+    """
+
+    def __init__(self, filename, max_age, batch_size, sources):
+        for index, source in enumerate(sources):
+            for other in sources[:index]:
+                if source.overlaps(other):
+                    raise ValueError('Sources {0} and {1} overlap'.format(
+                        other.name, source.name))
+        self._caches = list()
+        for source in sources:
+            source_filename = filename
+            if len(sources) > 1:
+                source_filename = source.get_cache_filename(filename)
+            self._caches.append(GerritQueryCache(source_filename, max_age,
+                batch_size, source))
+
+    def get_query_lines(self, force_update=False):
+        """Return a list of (GerritSource, query output lines) pairs."""
+        return self._map_caches(lambda x: x.get_query_lines(force_update))
+
+    def iter_query_lines(self, force_update=False):
+        """Return a list of (GerritSource, iterator over query output lines).
+
+        See GerritQueryCache.iter_query_lines()."""
+        return self._map_caches(lambda x: x.iter_query_lines(force_update))
+
+    def get_query_results(self, force_update=False):
+        results = GerritQueryResults()
+        for source, lines in self.get_query_lines(force_update):
+            results.add_query_results(lines, source)
+        return results
+
+    def _map_caches(self, func):
+        """Call func for each cache concurrently and pair results with sources."""
+        if len(self._caches) == 1:
+            all_results = [func(self._caches[0])]
+        else:
+            pool = multiprocessing.pool.ThreadPool(len(self._caches))
+            try:
+                all_results = pool.map(func, self._caches)
+            finally:
+                pool.close()
+        return [(cache.source, results)
+                for cache, results in zip(self._caches, all_results)]
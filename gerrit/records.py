@@ -20,6 +20,10 @@ class ChangeRecord(object):
         else:
             self.closed_on = None
 
+    @property
+    def change(self):
+        return self._change
+
     @property
     def author(self):
         return self._change.owner
@@ -67,10 +71,58 @@ class VoteRecord(object):
 
     """Record of a vote on a Gerrit change."""
 
-    def __init__(self, change, author, timestamp):
+    def __init__(self, change, author, timestamp, value):
         self.change = change
         self.author = author
         self.timestamp = timestamp
+        self.value = value
+
+
+class ReviewLatencyRecord(object):
+
+    """Record of review latencies for a Gerrit change.
+
+    All latencies are in hours from the creation of the change, or None if the
+    event has not happened.
+    """
+
+    def __init__(self, change, first_review, first_vote, merge, review_rounds):
+        self._change = change
+        self.first_review = first_review
+        self.first_vote = first_vote
+        self.merge = merge
+        self.review_rounds = review_rounds
+
+    @property
+    def author(self):
+        return self._change.owner
+
+
+def _hours_between(start, end):
+    return (end - start).total_seconds() / 3600.0
+
+
+class _SingleChangeData(object):
+
+    """Provides the GerritQueryResults interface for a single change."""
+
+    def __init__(self, change):
+        self.public_changes = list()
+        self.open_changes = list()
+        if not change.is_draft:
+            self.public_changes.append(change)
+            if change.is_open:
+                self.open_changes.append(change)
+
+
+def iter_change_records(changes, start_date, end_date):
+    """Create GerritRecords separately for each change.
+
+    This allows processing the changes one at a time (e.g., as they are
+    returned from gerrit.query.GerritQueryResults.iter_query_results()),
+    without keeping all the changes and records in memory."""
+    for change in changes:
+        yield GerritRecords(_SingleChangeData(change), start_date, end_date)
 
 
 class GerritRecords(object):
@@ -93,6 +145,7 @@ class GerritRecords(object):
         self._open_changes = None
         self._open_comments = None
         self._open_votes = None
+        self._review_latencies = None
 
     @property
     def change_activity(self):
@@ -139,6 +192,12 @@ class GerritRecords(object):
             self._open_votes = self._get_vote_records(self._data.open_changes)
         return self._open_votes
 
+    @property
+    def review_latencies(self):
+        if self._review_latencies is None:
+            self._review_latencies = self._get_review_latency_records(self._data.public_changes)
+        return self._review_latencies
+
     def _to_record_date(self, date):
         if date and (date.date() < self._start_date or date.date() > self._end_date):
             return None
@@ -171,6 +230,43 @@ class GerritRecords(object):
                     if approval.by.technical_account:
                         continue
                     timestamp = self._to_record_date(approval.granted_on)
-                    record = VoteRecord(change, approval.by, timestamp)
+                    record = VoteRecord(change, approval.by, timestamp,
+                            approval.value)
                     result.append(record)
         return result
+
+    def _get_review_latency_records(self, changes):
+        result = list()
+        for change in changes:
+            created_on = self._to_record_date(change.created_on)
+            if not created_on:
+                continue
+            first_review = None
+            first_vote = None
+            merge = None
+            review_rounds = 0
+            reviewed_patchset = False
+            for event in change.timeline:
+                if event.event_type == gerrit.query.ChangeEvent.Type.upload:
+                    reviewed_patchset = False
+                    continue
+                if event.event_type == gerrit.query.ChangeEvent.Type.submit:
+                    merge = _hours_between(created_on, event.timestamp)
+                    continue
+                if event.author.author_id == change.owner.author_id \
+                        or event.author.technical_account:
+                    continue
+                if event.event_type == gerrit.query.ChangeEvent.Type.vote:
+                    if first_vote is None:
+                        first_vote = _hours_between(created_on, event.timestamp)
+                elif event.event_type != gerrit.query.ChangeEvent.Type.comment:
+                    continue
+                if first_review is None:
+                    first_review = _hours_between(created_on, event.timestamp)
+                if not reviewed_patchset:
+                    review_rounds += 1
+                    reviewed_patchset = True
+            record = ReviewLatencyRecord(change, first_review, first_vote,
+                    merge, review_rounds)
+            result.append(record)
+        return result
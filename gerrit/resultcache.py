@@ -0,0 +1,114 @@
+# Copyright (c) 2016, Teemu Murtola
+
+"""Classes to cache computed statistics between runs."""
+
+import codecs
+import hashlib
+import os
+import os.path
+import tempfile
+import time
+
+def compute_fingerprint(query_lines):
+    """Compute a fingerprint of `gerrit query` results from multiple sources.
+
+    `query_lines` should be a list of (GerritSource, lines) pairs, as returned
+    by gerrit.query.GerritMultiQueryCache.get_query_lines()."""
+    digest = hashlib.sha1()
+    for source, lines in query_lines:
+        digest.update(source.name)
+        digest.update('\0')
+        digest.update(','.join(sorted(source.technical_accounts)))
+        digest.update('\0')
+        for line in lines:
+            digest.update(line.rstrip('\n'))
+            digest.update('\n')
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+class ReportResultCache(object):
+
+    """Manages an on-disk cache of formatted statistics tables.
+
+    Each entry is stored in a separate file in the cache directory, named by a
+    hash of the key.  Entries are evicted in least-recently-used order (based
+    on file modification times) when there are more than `max_entries` of them.
+    """
+
+    # Increase this whenever the output of existing reports changes.
+    version = 4
+
+    def __init__(self, directory, max_entries):
+        self._directory = directory
+        self._max_entries = max_entries
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+        self._evict()
+
+    def get_key(self, fingerprint, report_name, start_date, end_date,
+            options=()):
+        """Return a cache key for a report computed from given data.
+
+        `options` can contain strings for any other parameters that affect
+        the output."""
+        key = '{0}:{1}:{2}:{3}:{4}'.format(ReportResultCache.version,
+                fingerprint, report_name, start_date, end_date)
+        for option in options:
+            key += ':' + option
+        return hashlib.sha1(key).hexdigest()
+
+    def get(self, key):
+        """Return cached output for the key, or None if it is not cached."""
+        path = self._get_path(key)
+        try:
+            with codecs.open(path, 'r', 'utf-8') as fp:
+                result = fp.read()
+        except IOError:
+            return None
+        os.utime(path, None)
+        return result
+
+    def put(self, key, result):
+        """Store output for the key, evicting old entries if necessary."""
+        fd, temp_path = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(result.encode('utf-8'))
+            os.rename(temp_path, self._get_path(key))
+        except:
+            os.remove(temp_path)
+            raise
+        self._evict()
+
+    def _get_path(self, key):
+        return os.path.join(self._directory, key + '.txt')
+
+    # Age in seconds after which temporary files are considered to be left
+    # over from an interrupted put(), and are removed.
+    _max_temp_age = 3600
+
+    def _evict(self):
+        """Remove least recently used entries and stale temporary files."""
+        entries = list()
+        now = time.time()
+        for filename in os.listdir(self._directory):
+            path = os.path.join(self._directory, filename)
+            try:
+                mtime = os.path.getmtime(path)
+                if filename.endswith('.tmp'):
+                    if now - mtime > self._max_temp_age:
+                        os.remove(path)
+                elif filename.endswith('.txt'):
+                    entries.append((mtime, path))
+            except OSError:
+                # Removed concurrently by another process.
+                continue
+        if len(entries) <= self._max_entries:
+            return
+        entries.sort()
+        for mtime, path in entries[:len(entries) - self._max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -1,6 +1,13 @@
 # Copyright (c) 2014, Teemu Murtola
 
+import collections
 import copy
+import csv
+import heapq
+import itertools
+import json
+import math
+import StringIO
 
 class StatisticsColumn(object):
     def __init__(self, name):
@@ -16,17 +23,49 @@ class StatisticsColumn(object):
     def to_string(self, value):
         return unicode(value)
 
+    def to_data(self, value):
+        return self.to_sortable(value)
+
     def accumulate(self, base, value):
         return base + value
 
+    def combine(self, base, other):
+        return base + other
+
+    def to_group_key(self, value):
+        return value
+
+    def finalize(self, value):
+        """Convert an accumulated value to the value passed to to_sortable(),
+        to_string(), and to_data().  Called once per group before printing."""
+        return value
+
 
 class StatisticsAuthorNameColumn(StatisticsColumn):
+    # Records are grouped by account, and the accounts are mapped to authors
+    # only when printing, since more accounts may get merged while records
+    # are being processed.
     def __init__(self, name, get_author):
         StatisticsColumn.__init__(self, name)
         self._get_author = get_author
+        self._authors = dict()
 
     def get_value(self, record):
-        return self._get_author(record).fullname
+        author = self._get_author(record)
+        self._authors[author.account_id] = author
+        return author.account_id
+
+    def to_group_key(self, value):
+        author = self._authors[value]
+        author_id = author.author_id
+        self._authors.setdefault(author_id, author)
+        return author_id
+
+    def to_sortable(self, value):
+        return self._authors[value].fullname
+
+    def to_string(self, value):
+        return unicode(self._authors[value].fullname)
 
 
 class StatisticsCountColumn(StatisticsColumn):
@@ -63,24 +102,79 @@ class StatisticsDistinctCountColumn(StatisticsColumn):
             base.add(value)
         return base
 
+    def combine(self, base, other):
+        base.update(other)
+        return base
+
+
+class StatisticsPercentileColumn(StatisticsColumn):
+    def __init__(self, name, get_value, percentile, value_format=u'{0:.1f}'):
+        StatisticsColumn.__init__(self, name)
+        self._get_value = get_value
+        self._percentile = percentile
+        self._value_format = value_format
+
+    @property
+    def default_value(self):
+        return list()
+
+    def get_value(self, record):
+        return self._get_value(record)
+
+    def finalize(self, value):
+        if not value:
+            return None
+        values = sorted(value)
+        rank = int(math.ceil(self._percentile / 100.0 * len(values)))
+        return values[max(rank, 1) - 1]
+
+    def to_string(self, value):
+        if value is None:
+            return u'-'
+        return self._value_format.format(value)
+
+    def accumulate(self, base, value):
+        if value is not None:
+            base.append(value)
+        return base
+
 
 class Statistics(object):
+    # Number of lines to format before each write to the output.
+    _block_size = 1000
+
     def __init__(self, group_columns):
         self._group_columns = group_columns
         self._columns = list()
+        self._column_indices = dict()
         self._init_values = list()
         self._groups = dict()
 
     def process_records(self, records, columns):
+        self.add_columns(columns)
+        self.accumulate_records(records, columns)
+
+    def add_columns(self, columns):
+        """Add columns without processing any records.
+
+        Records can then be processed incrementally with accumulate_records().
+        """
         existing_columns = len(self._columns)
         self._columns.extend(columns)
+        for index, column in enumerate(columns, existing_columns):
+            self._column_indices[column] = index
         new_init_values = [column.default_value for column in columns]
         self._init_values.extend(new_init_values)
         for group in self._groups.itervalues():
             group.extend(copy.deepcopy(new_init_values))
+
+    def accumulate_records(self, records, columns):
+        """Accumulate records into columns previously added with add_columns()."""
+        indexed_columns = [(self._column_indices[column], column)
+                for column in columns]
         for record in records:
             group = self._get_group(record)
-            for index, column in enumerate(columns, existing_columns):
+            for index, column in indexed_columns:
                 value = column.get_value(record)
                 group[index] = column.accumulate(group[index], value)
 
@@ -101,27 +195,102 @@ class Statistics(object):
                 return index
         raise ValueError('Unknown column name: ' + column_name)
 
-    def print_stats(self, fp, sort_by=None):
-        all_columns = self._group_columns + self._columns
-        titles = [column.name for column in all_columns]
-        lines = [list(key) + value for key, value in self._groups.iteritems()
-                if any([value[i] != column.default_value
-                    for i, column in enumerate(self._columns)])]
+    def _merge_groups(self):
+        """Merge groups whose keys map to the same group key."""
+        groups = dict()
+        for key, group in self._groups.iteritems():
+            key = tuple(column.to_group_key(value)
+                    for column, value in zip(self._group_columns, key))
+            existing = groups.get(key)
+            if existing is None:
+                groups[key] = group
+                continue
+            for index, column in enumerate(self._columns):
+                existing[index] = column.combine(existing[index], group[index])
+        self._groups = groups
+
+    def _get_lines(self, sort_by, top):
+        self._merge_groups()
+        lines = (list(key) + [column.finalize(x)
+                    for column, x in zip(self._columns, value)]
+                for key, value in self._groups.iteritems()
+                if value != self._init_values)
         if sort_by:
             sort_by_index = self._find_column_index(sort_by)
-            column = all_columns[sort_by_index]
-            lines.sort(key=lambda x: column.to_sortable(x[sort_by_index]), reverse=True)
-        widths = list()
-        for index, column in enumerate(all_columns):
-            max_value_len = max([len(column.to_string(x[index])) for x in lines])
-            widths.append(max(len(titles[index]), max_value_len))
-        for elem, width in zip(titles, widths):
-            fp.write(u'{0:{width}} '.format(elem, width=width));
-        fp.write('\n')
-        for width in widths:
-            fp.write(u'{0:=^{width}} '.format('', width=width));
-        fp.write('\n')
-        for line in lines:
-            for elem, column, width in zip(line, all_columns, widths):
-                fp.write(u'{0:{width}} '.format(column.to_string(elem), width=width));
-            fp.write('\n')
+            column = (self._group_columns + self._columns)[sort_by_index]
+            sort_key = lambda x: column.to_sortable(x[sort_by_index])
+            if top is not None:
+                return heapq.nlargest(top, lines, key=sort_key)
+            return sorted(lines, key=sort_key, reverse=True)
+        if top is not None:
+            return list(itertools.islice(lines, top))
+        return list(lines)
+
+    def get_rows(self, sort_by=None, top=None):
+        """Return the statistics as a list of rows, one per group.
+
+        Each row is an ordered dictionary from column names to values that
+        can be serialized as JSON.  `sort_by` and `top` work as in
+        print_stats()."""
+        all_columns = self._group_columns + self._columns
+        return self._get_rows(all_columns, self._get_lines(sort_by, top))
+
+    def _get_rows(self, all_columns, lines):
+        return [collections.OrderedDict((column.name, column.to_data(elem))
+                    for elem, column in zip(line, all_columns))
+                for line in lines]
+
+    def print_stats(self, fp, sort_by=None, top=None, output_format='text'):
+        """Print the statistics, one line per group.
+
+        If `top` is given, only that many lines with the largest values in
+        the `sort_by` column are printed.  `output_format` can be 'text' for
+        a table aligned for reading, or 'json' or 'csv'."""
+        all_columns = self._group_columns + self._columns
+        lines = self._get_lines(sort_by, top)
+        if output_format == 'json':
+            self._print_json(fp, all_columns, lines)
+        elif output_format == 'csv':
+            self._print_csv(fp, all_columns, lines)
+        else:
+            self._print_text(fp, all_columns, lines)
+
+    def _print_text(self, fp, all_columns, lines):
+        titles = [column.name for column in all_columns]
+        cells = [[column.to_string(elem) for elem, column in zip(line, all_columns)]
+                for line in lines]
+        widths = [len(title) for title in titles]
+        for row in cells:
+            widths = [max(width, len(cell)) for width, cell in zip(widths, row)]
+        row_format = u''.join(u'{{{0}:{1}}} '.format(index, width)
+                for index, width in enumerate(widths)) + u'\n'
+        fp.write(row_format.format(*titles))
+        fp.write(row_format.format(*[u'=' * width for width in widths]))
+        for start in xrange(0, len(cells), self._block_size):
+            block = cells[start:start + self._block_size]
+            fp.write(u''.join([row_format.format(*row) for row in block]))
+
+    def _print_json(self, fp, all_columns, lines):
+        rows = self._get_rows(all_columns, lines)
+        fp.write(unicode(json.dumps(rows, indent=1)))
+        fp.write(u'\n')
+
+    def _print_csv(self, fp, all_columns, lines):
+        def encode(value):
+            if value is None:
+                return ''
+            if isinstance(value, unicode):
+                return value.encode('utf-8')
+            return value
+        buf = StringIO.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        writer.writerow([column.name for column in all_columns])
+        for start in xrange(0, len(lines), self._block_size):
+            block = lines[start:start + self._block_size]
+            writer.writerows([[encode(column.to_data(elem))
+                    for elem, column in zip(line, all_columns)]
+                for line in block])
+            fp.write(buf.getvalue().decode('utf-8'))
+            buf.seek(0)
+            buf.truncate()
+        fp.write(buf.getvalue().decode('utf-8'))